@@ -3,23 +3,28 @@
 '''Run Automat.'''
 
 import build
+import fs_utils
+import os
 import subprocess
+import sys
 import debian_deps
 from args import args
+from pathlib import Path
 from sys import platform, exit
 
-recipe = build.recipe()
+if __name__ == '__main__':
+    # Keep this under the `__main__` guard - the source scanner may spawn worker processes.
+    recipe = build.recipe()
 
-if args.verbose:
-    print('Build graph')
-    for step in recipe.steps:
-        print(' Step', step.shortcut)
-        print('  Inputs:')
-        for inp in sorted(str(x) for x in step.inputs):
-            print('    ', inp)
-        print('  Outputs: ', step.outputs)
+    if args.verbose:
+        print('Build graph')
+        for step in recipe.steps:
+            print(' Step', step.shortcut)
+            print('  Inputs:')
+            for inp in sorted(str(x) for x in step.inputs):
+                print('    ', inp)
+            print('  Outputs: ', step.outputs)
 
-if __name__ == '__main__':
     debian_deps.check_and_install()
     
     if args.fresh:
@@ -28,19 +33,22 @@ if __name__ == '__main__':
 
     active_recipe = None
 
+    if platform == 'linux':
+        import inotify
+        import src
+        # A single in-process watcher is kept across the rebuilds. Other files in `src/` don't affect the build.
+        build_scripts_dir = str(fs_utils.relative_to_root(Path(__file__).parent))
+        watcher = inotify.Watcher(['src/', build_scripts_dir], suffixes=src.SOURCE_EXTENSIONS + ('.py',))
+    elif platform != 'win32':
+        raise Exception(
+            f'Unknown platfrorm: "{platform}". Expected either "linux" or "win32". Automat is not supported on this platform yet!')
+
     while True:
         recipe.set_target(args.target)
-        if platform == 'linux':
-            events = 'CLOSE_WRITE'
-        elif platform == 'win32':
-            events = 'create,modify,delete,move'
-        else:
-            raise Exception(
-                f'Unknown platfrorm: "{platform}". Expected either "linux" or "win32". Automat is not supported on this platform yet!')
-
-        # TODO: include inotify-win in the build scripts for Windows
-        watcher = subprocess.Popen(
-            ['inotifywait', '-qe', events, 'src/'], stdout=subprocess.DEVNULL)
+        if platform == 'win32':
+            # TODO: include inotify-win in the build scripts for Windows
+            watcher = subprocess.Popen(
+                ['inotifywait', '-qe', 'create,modify,delete,move', 'src/'], stdout=subprocess.DEVNULL)
 
         ok = recipe.execute(watcher)
         if ok:
@@ -52,11 +60,20 @@ if __name__ == '__main__':
             break
         try:
             print('Watching src/ for changes...')
-            watcher.wait()
+            changed = watcher.wait()
         except KeyboardInterrupt:
             watcher.kill()
             break
-        # Reload the recipe because dependencies may have changed
-        recipe = build.recipe()
+        if platform == 'linux':
+            if any(os.path.dirname(path) == build_scripts_dir for path in changed):
+                # Modules of the build system can't be reloaded cleanly (their state & flags would leak into the new
+                # versions). Nothing is running at this point so the whole process is replaced instead.
+                print('Build scripts have been modified. Restarting...', flush=True)
+                os.execv(sys.executable, [sys.executable, str(Path(__file__).parent)] + sys.argv[1:])
+            # Reuse the recipe unless the changes affect the build graph
+            recipe = build.update(recipe, changed)
+        else:
+            # Reload the recipe because dependencies may have changed
+            recipe = build.recipe()
     if not ok:
         exit(1)
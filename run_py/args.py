@@ -13,6 +13,14 @@ parser = argparse.ArgumentParser(
 parser.add_argument('--fresh', action='store_true')
 parser.add_argument('--live', action='store_true')
 parser.add_argument('--verbose', action='store_true')
+parser.add_argument('-j', '--jobs', type=int,
+                    help='maximum number of steps to run in parallel (defaults to the number of available CPUs)')
+parser.add_argument('--pgo-generate', action='store_true',
+                    help='instrument the release build - running it collects profiles for profile-guided optimization')
+parser.add_argument('--bolt', action='store_true',
+                    help='keep relocations in the release binaries & add the `<binary>.bolt` steps that optimize them with llvm-bolt')
+parser.add_argument('--ninja', action='store_true',
+                    help='compile & link the binaries with Ninja (using build/build.ninja) instead of the Python scheduler')
 parser.add_argument('target')
 parser.add_argument('-x', action='append',
                     help='argument passed to the target', dest='extra_args', default=[])
@@ -1,16 +1,26 @@
 from functools import partial
-from sys import platform
 
-import cmake
 import fs_utils
 import build
 import os
 import make
 import re
+from args import args
 
 Popen = make.Popen
 
-package_name_re = re.compile(r'(?P<name>[A-Za-z0-9_\-]+)-(?P<version>[0-9.]+)\.tar\.(?:gz|xz|bz2)')
+# Parallelism of the `make` runs - limited by the same `--jobs` as the rest of the build
+make_jobs = str(args.jobs or make.available_cpus())
+
+package_name_re = re.compile(r'(?P<name>[A-Za-z0-9_\-]+)-(?P<version>[0-9.]+)\.tar\.(?:gz|xz|bz2|zst)')
+
+def download(url, tarball):
+  # Downloads into a temporary file so an interrupted download doesn't look finished. Running the step again
+  # resumes the download from where it stopped.
+  part = tarball.with_name(tarball.name + '.part')
+  p = Popen(['curl', '-L', '--fail', '--retry', '3', '-C', '-', url, '-o', part])
+  p.on_success = partial(os.replace, part, tarball)
+  return p
 
 # Adds the given package to the recipe build graph
 def register_package(recipe, url, inputs=[], outputs=[]):
@@ -24,7 +34,7 @@ def register_package(recipe, url, inputs=[], outputs=[]):
   tarball = fs_utils.build_dir / filename
 
   recipe.add_step(
-      partial(Popen, ['curl', '-L', url, '-o', tarball]),
+      partial(download, url, tarball),
       outputs=[tarball],
       inputs=[],
       desc = f'Downloading {name}',
@@ -48,7 +58,8 @@ def register_package(recipe, url, inputs=[], outputs=[]):
 
       env = os.environ.copy()
       env['PKG_CONFIG_PATH'] = f'{prefix}/share/pkgconfig:{prefix}/lib/pkgconfig'
-      env['CC'] = build.compiler_c
+      # Compiled through the same compiler cache (and its settings from `build`) as Automat's own sources
+      env['CC'] = ' '.join([*build.compiler_launcher, build.compiler_c])
       env['CFLAGS'] = ' '.join(build_type.CFLAGS())
       return Popen([(source_dir / 'configure').absolute(), '--prefix', prefix], env=env, cwd=build_dir)
     
@@ -60,7 +71,7 @@ def register_package(recipe, url, inputs=[], outputs=[]):
         shortcut=f'configure {name}{build_type.rule_suffix()}')
     
     recipe.add_step(
-        partial(Popen, ['make', 'install', '-j', '8'], cwd=build_dir),
+        partial(Popen, ['make', 'install', '-j', make_jobs], cwd=build_dir),
         outputs=build_outputs,
         inputs=[build_dir / 'Makefile'],
         desc=f'Building {name}{build_type.rule_suffix()}',
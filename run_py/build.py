@@ -5,15 +5,35 @@ from itertools import product
 import src
 import fs_utils
 import make
+import ninja
+import cxxfilt
 import os
 import functools
+import hashlib
 import json
+import re
+import shlex
+import shutil
+import subprocess
+import time
 from args import args
-from dataclasses import dataclass
 from sys import platform
 
 TRIPLE = 'x86_64-pc-linux-gnu'
 
+gcc_version_re = re.compile(r'[0-9]+(\.[0-9]+)*')
+
+
+def newest_gcc_dir(gcc_arch_dir: Path) -> Path | None:
+    '''Returns the directory of the newest GCC version installed in `gcc_arch_dir`.'''
+    with os.scandir(gcc_arch_dir) as entries:
+        # Versions are either major-only (`14`) or full (`10.3.0`). Other entries are skipped.
+        versions = [entry.name for entry in entries if gcc_version_re.fullmatch(entry.name) and entry.is_dir()]
+    if not versions:
+        return None
+    return gcc_arch_dir / max(versions, key=lambda name: tuple(int(x) for x in name.split('.')))
+
+
 class BuildType:
     def __init__(self, name, base=None, is_default=False):
         self.name = name
@@ -24,12 +44,13 @@ class BuildType:
         self.is_default = is_default
 
         gcc_arch_dir = self.PREFIX() / 'lib' / 'gcc' / TRIPLE
-        if gcc_arch_dir.exists():
-            # TODO: support versions like 10.3.0
-            gcc_version = max(int(x.name) for x in gcc_arch_dir.iterdir() if x.is_dir())
-            gcc_dir = gcc_arch_dir / str(gcc_version)
+        try:
+            gcc_dir = newest_gcc_dir(gcc_arch_dir)
+        except FileNotFoundError:
+            gcc_dir = None
+        if gcc_dir:
             if args.verbose:
-                print(f'{self.name} build using GCC', gcc_version, 'from', gcc_dir)
+                print(f'{self.name} build using GCC', gcc_dir.name, 'from', gcc_dir)
             self.compile_args += [f'--gcc-install-dir={gcc_dir}']
             self.link_args += [f'--gcc-install-dir={gcc_dir}']
         elif args.verbose:
@@ -45,14 +66,23 @@ class BuildType:
     def PREFIX(self): # TODO: change this to a member variable
         return (fs_utils.build_dir / 'prefix' / self.name).absolute()
     
+    def chain(self):
+        '''This build type and its bases - starting from the most basic one.'''
+        chain = []
+        build_type = self
+        while build_type:
+            chain.append(build_type)
+            build_type = build_type.base
+        return reversed(chain)
+
     def CXXFLAGS(self):
-        return [str(x) for x in (self.base.CXXFLAGS() if self.base else []) + self.compile_args]
+        return [str(x) for build_type in self.chain() for x in build_type.compile_args]
 
     def CFLAGS(self):
         return [x for x in self.CXXFLAGS() if x != '-std=gnu++2c']
     
     def LDFLAGS(self):
-        return [str(x) for x in (self.base.LDFLAGS() if self.base else []) + self.link_args]
+        return [str(x) for build_type in self.chain() for x in build_type.link_args]
     
     def __str__(self):
         return self.name
@@ -85,8 +115,8 @@ fast.compile_args += ['-O1']
 
 # Build type intended for practical usage (slow to build but very high performance)
 release = BuildType('Release', base)
-release.compile_args += ['-O3', '-DNDEBUG', '-flto', '-fstack-protector', '-fno-trapping-math']
-release.link_args += ['-flto']
+release.compile_args += ['-O3', '-DNDEBUG', '-flto=thin', '-fstack-protector', '-fno-trapping-math']
+release.link_args += ['-flto=thin']
 
 # Build type intended for debugging
 debug = BuildType('Debug', base)
@@ -138,15 +168,25 @@ class Binary:
         return f'Binary({self.path}, {self.objects}, {self.link_args}, {self.run_args}, {self.build_type})'
 
 
+# Objects of each build type are kept in their own subdirectory (with their depfiles). The object cache
+# (`OBJ_CACHE`) is their sibling - on the same filesystem, so its entries can be hard linked into place. The objects
+# no longer have unique file names - the shortcuts of their compile steps come from `obj_name`.
 OBJ_DIR = fs_utils.build_dir / 'obj'
-OBJ_DIR.mkdir(parents=True, exist_ok=True)
+for build_type in types:
+    assert build_type.name_lower != 'cache', 'build/obj/cache is the object cache'
+    (OBJ_DIR / build_type.name_lower).mkdir(parents=True, exist_ok=True)
 
 
-def obj_path(src_path: Path, build_type: BuildType = default) -> Path:
+def obj_name(stem: str, build_type: BuildType = default) -> str:
+    '''Unique name of the object - used for the shortcuts of the compile steps.'''
     if build_type == default:
-        return OBJ_DIR / (src_path.stem + '.o')
+        return stem + '.o'
     else:
-        return OBJ_DIR / (build_type.name_lower + '_' + src_path.stem + '.o')
+        return build_type.name_lower + '_' + stem + '.o'
+
+
+def obj_path(src_path: Path, build_type: BuildType = default) -> Path:
+    return OBJ_DIR / build_type.name_lower / (src_path.stem + '.o')
     
 def libname(name):
     return f'{name}.lib' if platform == 'win32' else f'lib{name}.a'
@@ -155,11 +195,16 @@ binary_extension = '.exe' if platform == 'win32' else ''
 
 def plan(srcs) -> tuple[list[ObjectFile], list[Binary]]:
 
-    objs: dict[str, ObjectFile] = dict()
+    # Paths are split with string operations - constructing `Path` objects for every file is much slower
+    roots = {f: os.path.splitext(path)[0] for path, f in srcs.items()}
+    stems = {f: os.path.basename(root) for f, root in roots.items()}
+
+    # Objects keyed by the stems of their sources & their build types
+    objs: dict[tuple[str, BuildType], ObjectFile] = dict()
     sources = [f for f in srcs.values() if f.is_source()]
     for src_file, build_type in product(sources, types):
         f_obj = ObjectFile(obj_path(src_file.path, build_type))
-        objs[str(f_obj.path)] = f_obj
+        objs[stems[src_file], build_type] = f_obj
         f_obj.deps = set(src_file.transitive_includes)
         f_obj.deps.add(src_file)
         f_obj.source = src_file
@@ -168,38 +213,196 @@ def plan(srcs) -> tuple[list[ObjectFile], list[Binary]]:
         for inc in src_file.transitive_includes:
             f_obj.compile_args += inc.build_compile_args(build_type.name_lower)
 
+    # Objects & .cc counterparts of every file - computed once rather than on every visit in the loop below
+    file_objs = {(f, build_type): objs.get((stems[f], build_type), None)
+                 for f, build_type in product(srcs.values(), types)}
+    file_cc = {f: srcs.get(root + '.cc', None) for f, root in roots.items()}
+
     binaries: list[Binary] = []
     main_sources = [f for f in sources if f.main]
-    for src_file, build_type in product(main_sources, types):
-        bin_name = src_file.path.stem
-        if build_type != default:
-            bin_name = build_type.name_lower + '_' + bin_name
-        bin_path = fs_utils.build_dir / bin_name
-        if binary_extension:
-            bin_path = bin_path.with_suffix(binary_extension)
-        bin_file = Binary(bin_path)
-        bin_file.build_type = build_type
-        binaries.append(bin_file)
-
-        queue: list[src.File] = [src_file]
+    for src_file in main_sources:
+        # Files that end up in the binary. `transitive_includes` are already closed so only the main source & the
+        # .cc counterparts of the reached files start new traversals. The result is shared by all build types.
+        reachable: list[src.File] = []
         visited: set[src.File] = set()
-        while queue:
-            f = queue.pop()
-            if f in visited:
+        roots: list[src.File] = [src_file]
+        while roots:
+            root = roots.pop()
+            if root in visited:
                 continue
-            visited.add(f)
-            bin_file.link_args += f.build_link_args(build_type.name_lower)
-            bin_file.run_args += f.build_run_args(build_type.name_lower)
-            if f_obj := objs.get(str(obj_path(f.path, build_type)), None):
-                if f_obj not in bin_file.objects:
-                    bin_file.objects.append(f_obj)
-            queue.extend(f.transitive_includes)
-            if f_cc := srcs.get(str(f.path.with_suffix('.cc')), None):
-                queue.append(f_cc)
+            for f in (root, *root.transitive_includes):
+                if f in visited:
+                    continue
+                visited.add(f)
+                reachable.append(f)
+                if f_cc := file_cc.get(f, None):
+                    roots.append(f_cc)
+
+        for build_type in types:
+            bin_name = stems[src_file]
+            if build_type != default:
+                bin_name = build_type.name_lower + '_' + bin_name
+            bin_path = fs_utils.build_dir / bin_name
+            if binary_extension:
+                bin_path = bin_path.with_suffix(binary_extension)
+            bin_file = Binary(bin_path)
+            bin_file.build_type = build_type
+            binaries.append(bin_file)
+
+            # Headers & their .cc counterparts share an object - it's added once (dicts keep the insertion order)
+            bin_objects: dict[ObjectFile, None] = {}
+            for f in reachable:
+                bin_file.link_args += f.build_link_args(build_type.name_lower)
+                bin_file.run_args += f.build_run_args(build_type.name_lower)
+                if f_obj := file_objs.get((f, build_type), None):
+                    bin_objects[f_obj] = None
+            bin_file.objects = list(bin_objects)
 
     return list(objs.values()), binaries
 
 
+# Depfile entries are separated by unescaped whitespace
+depfile_token_re = re.compile(r'(?:\\.|[^\s\\])+')
+
+# Only headers from these directories are taken from depfiles. System & third-party headers change only when
+# their own (separately tracked) build steps run.
+depfile_dirs = (str(fs_utils.relative_to_root(fs_utils.src_dir)) + os.sep, str(fs_utils.generated_dir) + os.sep)
+
+
+def read_depfile(path: Path) -> list[str]:
+    '''Returns all of the files listed in a Makefile-style depfile written by `-MD -MF <path>`.'''
+    try:
+        text = path.read_text()
+    except FileNotFoundError:
+        return []
+    _, _, deps = text.replace('\\\n', ' ').partition(': ')
+    return [dep.replace('\\ ', ' ') for dep in depfile_token_re.findall(deps)]
+
+
+def load_depfile(path: Path) -> set[str]:
+    '''Returns the project files listed in a Makefile-style depfile written by `-MD -MF <path>`.
+
+    Depfiles come from the previous compilation so they catch includes that the scanner in `src.py` can't see
+    (for example headers found through `-I` or included with `<...>`).'''
+    result = set()
+    for dep in read_depfile(path):
+        if os.path.isabs(dep):
+            dep = os.path.relpath(dep, fs_utils.project_root)
+        dep = os.path.normpath(dep)
+        if dep.startswith(depfile_dirs) and os.path.exists(dep):
+            result.add(dep)
+    return result
+
+
+# Object files indexed by the hash of their compilation command & the contents of all the files that it read.
+# Switching branches back and forth (or reverting an edit) brings back the old objects without compiling them.
+OBJ_CACHE = OBJ_DIR / 'cache'
+
+# Cache entries that weren't used for this long are removed
+OBJ_CACHE_MAX_AGE = 14 * 24 * 60 * 60
+# Above this total size of the cached objects the least recently used entries are removed
+OBJ_CACHE_MAX_SIZE = 5 * 1024 * 1024 * 1024
+
+
+def mtime_ns(path: Path) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def obj_cache_key(command: list[str], depfile: Path, modified_before: int | None = None) -> str | None:
+    '''Hash of the compilation `command` and of the contents of the files listed in its `depfile`.
+
+    Returns None when the key can't be computed - there is no depfile or (if `modified_before` is given) some
+    file has been modified after the `modified_before` timestamp (in ns).'''
+    deps = read_depfile(depfile)
+    if not deps:
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        st = os.stat(command[0])  # the compiler
+    except FileNotFoundError:
+        return None
+    h.update(f'{st.st_mtime_ns} {st.st_size}\0'.encode())
+    h.update('\0'.join(command).encode())
+    for dep in sorted(set(deps)):
+        if modified_before is not None and mtime_ns(dep) >= modified_before:
+            return None
+        h.update(f'\0{dep} {make.hexdigest(dep)}'.encode())
+    return h.hexdigest()
+
+
+def link_or_copy(src_path: Path, dst_path: Path):
+    '''Atomically replaces `dst_path` with a hard link to `src_path` (or a copy if the filesystem can't link it).'''
+    tmp_path = dst_path.with_name(dst_path.name + '.tmp')
+    tmp_path.unlink(missing_ok=True)
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
+def store_in_obj_cache(command: list[str], obj_path: Path, depfile: Path, start_ns: int):
+    if key := obj_cache_key(command, depfile, modified_before=start_ns):
+        OBJ_CACHE.mkdir(exist_ok=True)
+        # Depfiles are copied - compilers may write them in place
+        shutil.copyfile(depfile, OBJ_CACHE / f'{key}.d')
+        link_or_copy(obj_path, OBJ_CACHE / f'{key}.o')
+
+
+def compile_cached(command: list[str], obj_path: Path, depfile: Path):
+    '''Compiles an object file - unless the same command was already executed on the same files.
+
+    The lookup uses the depfile left by the previous compilation. A different set of includes makes a different
+    key so it may produce a miss, but never a wrong object.
+
+    Cached objects are hard links to the object files. Compilers (and assemblers) unlink their outputs before
+    writing them - the old object is also removed here, so a cached inode is never modified in place.'''
+    key = obj_cache_key(command, depfile)
+    if key and (OBJ_CACHE / f'{key}.o').exists():
+        shutil.copyfile(OBJ_CACHE / f'{key}.d', depfile)
+        link_or_copy(OBJ_CACHE / f'{key}.o', obj_path)
+        os.utime(obj_path)  # newer than the inputs (also marks the cache entry as recently used)
+        return None
+    obj_path.unlink(missing_ok=True)
+    p = make.Popen(compiler_launcher + command)
+    p.on_success = functools.partial(store_in_obj_cache, command, obj_path, depfile, time.time_ns())
+    return p
+
+
+def prune_obj_cache():
+    '''Removes the entries that weren't used for `OBJ_CACHE_MAX_AGE` & the least recently used ones above
+    `OBJ_CACHE_MAX_SIZE`. Cache hits touch the objects so their mtime is the time of the last use.'''
+    deadline = time.time() - OBJ_CACHE_MAX_AGE
+    try:
+        with os.scandir(OBJ_CACHE) as it:
+            entries = [(entry.path, entry.stat()) for entry in it if entry.name.endswith('.o')]
+    except FileNotFoundError:
+        return
+    entries.sort(key=lambda entry: entry[1].st_mtime, reverse=True)  # most recently used first
+    total_size = 0
+    for path, st in entries:
+        total_size += st.st_size
+        if st.st_mtime < deadline or total_size > OBJ_CACHE_MAX_SIZE:
+            os.unlink(path)
+            Path(path).with_suffix('.d').unlink(missing_ok=True)
+
+
+def rsp_quote(arg: str) -> str:
+    '''Quotes `arg` for a response file (clang tokenizes them like the command line of the host platform).'''
+    return subprocess.list2cmdline([arg]) if platform == 'win32' else shlex.quote(arg)
+
+
+def link(command: list[str], objects: list[str], rsp_path: Path):
+    '''Runs the linker `command` with the `objects` passed through a response file at `rsp_path`.
+
+    Binaries can have thousands of objects - their paths alone could exceed the command line limits.'''
+    fs_utils.write_if_changed(rsp_path, ''.join(rsp_quote(obj) + '\n' for obj in objects))
+    return make.Popen([command[0], f'@{rsp_path}', *command[1:]], stderr_prettifier=cxxfilt.cxxfilt)
+
+
 compiler = os.environ['CXX'] = os.environ['CXX'] if 'CXX' in os.environ else 'clang++'
 compiler_c = os.environ['CC'] = os.environ['CC'] if 'CC' in os.environ else 'clang'
 
@@ -211,14 +414,30 @@ else:
     base.link_args += ['-Wl,--gc-sections', '-Wl,--build-id=none']
     release.link_args += ['-Wl,--strip-all', '-Wl,-z,relro', '-Wl,-z,now']
 
+# ThinLTO cache lets the linker reuse the optimized modules whose inputs didn't change since the last link
+THINLTO_CACHE = fs_utils.build_dir / 'thinlto-cache'
+if platform == 'win32':
+    thinlto_cache_args = [f'-Wl,/lldltocache:{THINLTO_CACHE}']
+else:
+    thinlto_cache_args = [f'-Wl,--thinlto-cache-dir={THINLTO_CACHE}', '-Wl,--thinlto-cache-policy=cache_size_bytes=5g']
+release.link_args += thinlto_cache_args
+
 if False:
     debug.compile_args += ['-fsanitize=address', '-fsanitize-address-use-after-return=always']
     debug.link_args += ['-fsanitize=address']
 
 
+# Absolute paths of the compilers. Resolved once here rather than by every spawned compilation.
+compiler_path = fs_utils.which(compiler) or compiler
+compiler_c_path = fs_utils.which(compiler_c) or compiler_c
+
 if 'g++' in compiler and 'clang' not in compiler:
     # GCC doesn't support -fcolor-diagnostics
     base.compile_args.remove('-fcolor-diagnostics')
+    # GCC doesn't support ThinLTO
+    release.compile_args[release.compile_args.index('-flto=thin')] = '-flto'
+    release.link_args[release.link_args.index('-flto=thin')] = '-flto'
+    release.link_args = [x for x in release.link_args if x not in thinlto_cache_args]
 
 if 'OPENWRT_BUILD' in os.environ:
     # OpenWRT has issues with -static C++ builds
@@ -226,33 +445,118 @@ if 'OPENWRT_BUILD' in os.environ:
     base.link_args.append('-lgcc_pic')
     # OpenWRT doesn't come with lld
     base.link_args.remove('-fuse-ld=lld')
+    release.link_args = [x for x in release.link_args if x not in thinlto_cache_args]
+
+# Profile-guided optimization of release builds (clang only):
+# 1. `run release_automat --pgo-generate` builds & runs an instrumented binary, which writes profiles to `PGO_DIR`.
+# 2. Later release builds merge the profiles into `PGO_PROFILE` and optimize the hot paths with it.
+# Removing `PGO_DIR` goes back to regular release builds.
+PGO_DIR = fs_utils.build_dir / 'pgo'
+PGO_PROFILE = PGO_DIR / 'default.profdata'
+pgo_use = False
+if 'clang' in compiler:
+    # The tool from the same LLVM installation as the compiler can read its raw profiles
+    llvm_profdata = Path(compiler_path).with_name('llvm-profdata')
+    llvm_profdata = str(llvm_profdata) if llvm_profdata.exists() else fs_utils.which('llvm-profdata')
+    if args.pgo_generate:
+        release.compile_args += [f'-fprofile-generate={PGO_DIR}']
+        release.link_args += [f'-fprofile-generate={PGO_DIR}']
+    elif next(PGO_DIR.glob('*.profraw'), None):  # the training run may not have written any profiles yet
+        if llvm_profdata:
+            pgo_use = True
+        else:
+            print(f'Warning: `llvm-profdata` not found - the profiles in {PGO_DIR} are not used')
+    if pgo_use:
+        release.compile_args += [f'-fprofile-use={PGO_PROFILE}', '-Wno-profile-instr-out-of-date',
+                                 '-Wno-profile-instr-unprofiled']
+
+# Post-link optimization of release binaries with BOLT (https://github.com/llvm/llvm-project/tree/main/bolt):
+# `run release_automat.bolt --bolt` instruments the binary, runs it for training & writes the optimized binary using
+# the collected profile. BOLT needs the relocations & symbols so only `--bolt` keeps them in the release binaries.
+llvm_bolt = fs_utils.which('llvm-bolt') if args.bolt and platform == 'linux' else None
+if args.bolt and not llvm_bolt:
+    print('Warning: `llvm-bolt` not found (or not supported on this platform) - release binaries are not optimized with BOLT')
+if llvm_bolt:
+    release.link_args = [x for x in release.link_args if x != '-Wl,--strip-all'] + ['-Wl,-q']
 
 if args.verbose:
     base.compile_args.append('-v')
 
-@dataclass
-class CompilationEntry:
-    file: str
-    output: str
-    arguments: list
+# Compiler cache that wraps object compilation (linking is never cached)
+compiler_launcher = []
+if ccache := fs_utils.which('ccache'):
+    compiler_launcher = [ccache]
+    # Share cache entries between checkouts & ignore the mtime churn caused by switching branches
+    os.environ.setdefault('CCACHE_BASEDIR', str(fs_utils.project_root))
+    os.environ.setdefault('CCACHE_COMPILERCHECK', 'content')
+    os.environ.setdefault('CCACHE_SLOPPINESS', 'pch_defines,time_macros,include_file_mtime')
+elif sccache := fs_utils.which('sccache'):
+    compiler_launcher = [sccache]
+
+# Extensions add their flags to the build types when they're executed. These are the flags from before that -
+# restored whenever the extensions have to be executed again, so nothing is added twice.
+build_type_flags = [(t, list(t.compile_args), list(t.link_args)) for t in [base] + types]
+
+# Extensions executed by `load_extensions`, keyed by `src.extensions_key()`
+loaded_extensions: dict[tuple, list] = {}
+
+
+def load_extensions() -> list:
+    '''Returns the extensions from `src/`. They're executed again only after their sources change.'''
+    key = src.extensions_key()
+    if key not in loaded_extensions:
+        for build_type, compile_args, link_args in build_type_flags:
+            build_type.compile_args = list(compile_args)
+            build_type.link_args = list(link_args)
+        loaded_extensions.clear()
+        loaded_extensions[key] = src.load_extensions()
+    return loaded_extensions[key]
+
+
+# Build file for running the compile & link steps with Ninja (see the `build.ninja` step)
+NINJA_FILE = fs_utils.build_dir / 'build.ninja'
+
+# With `--ninja` the link steps run Ninja, which compiles & links the binaries on its own
+ninja_path = fs_utils.which('ninja') if args.ninja else None
+if args.ninja and not ninja_path:
+    print('Warning: `ninja` not found - compiling with the Python scheduler')
+ninja_command = [ninja_path, '-f', str(NINJA_FILE)] + (['-j', str(args.jobs)] if args.jobs else [])
+
+# Link steps handed over to Ninja: (step, inputs of the link edge, compile steps of its objects)
+ninja_links: list[tuple[make.Step, set[str], list[make.Step]]] = []
+
+
+def update_ninja_links():
+    '''Makes the Ninja link steps depend directly on the inputs of the compile steps that Ninja runs for them.'''
+    for step, link_inputs, compiles in ninja_links:
+        inputs = set(link_inputs)
+        for compile_step in compiles:
+            inputs |= compile_step.inputs
+        inputs -= set().union(*(compile_step.outputs for compile_step in compiles))
+        step.inputs = inputs
+
+
+# Compile steps of the last recipe: (step, inputs known without the depfile, depfile, mtime of the depfile)
+compile_steps: list[tuple[make.Step, set, Path, int]] = []
 
 
 def recipe() -> make.Recipe:
     r = make.Recipe()
-    extensions = src.load_extensions()
+    compile_steps.clear()
+    extensions = load_extensions()
 
     for ext in extensions:
         if hasattr(ext, 'hook_recipe'):
             ext.hook_recipe(r)
 
     srcs = src.scan()
+    r.generated.add(src.SCAN_CACHE)
 
     for ext in extensions:
         if hasattr(ext, 'hook_srcs'):
             ext.hook_srcs(srcs, r)
 
-    for file in srcs.values():
-        file.update_transitive_includes(srcs)
+    src.update_transitive_includes(srcs)
 
     objs, bins = plan(srcs)
 
@@ -260,38 +564,61 @@ def recipe() -> make.Recipe:
         if hasattr(ext, 'hook_plan'):
             ext.hook_plan(srcs, objs, bins, r)
 
-    compilation_db = []
+    # Compile & link steps exported to `build.ninja`: (step, command, source, depfile)
+    ninja_edges: list[tuple[make.Step, list[str], str | None, Path | None]] = []
+    # Entries of `compile_commands.json` - ready to be serialized
+    compilation_db: list[dict] = []
+    directory = str(fs_utils.project_root)
+    # Flags of each build type - resolved once rather than for every object
+    build_types = set(obj.build_type for obj in objs)
+    cflags = {build_type: build_type.CFLAGS() for build_type in build_types}
+    cxxflags = {build_type: build_type.CXXFLAGS() for build_type in build_types}
     for obj in objs:
+        depfile = obj.path.with_suffix('.d')
+        shortcut = obj_name(obj.path.stem, obj.build_type)
         if obj.source.path.name.endswith('.c'):
-            pargs = [compiler_c] + obj.build_type.CFLAGS()
+            compiler_name, executable, flags = compiler_c, compiler_c_path, cflags[obj.build_type]
         else:
-            pargs = [compiler] + obj.build_type.CXXFLAGS()
-
-        pargs += obj.compile_args
-        pargs += [str(obj.source.path)]
-        pargs += ['-c', '-o', str(obj.path)]
-        builder = functools.partial(make.Popen, pargs)
+            compiler_name, executable, flags = compiler, compiler_path, cxxflags[obj.build_type]
+        args = [*flags, *obj.compile_args, str(obj.source.path), '-MD', '-MF', str(depfile), '-c', '-o', str(obj.path)]
+        # `compile_commands.json` gets the compiler as configured (without the launcher) - clangd expects the
+        # compiler in the first argument
+        builder = functools.partial(compile_cached, [executable, *args], obj.path, depfile)
+        # Stringified once - the same set is kept in `compile_steps` for refreshing the depfile inputs
+        inputs = {str(dep) for dep in obj.deps}
+        inputs.add('compile_commands.json')
+        if pgo_use and obj.build_type == release:
+            inputs.add(str(PGO_PROFILE))
         r.add_step(builder,
                    outputs=[obj.path],
-                   inputs=obj.deps | set(['compile_commands.json']),
-                   desc=f'Compiling {obj.path.name}',
-                   shortcut=obj.path.name)
+                   inputs=inputs | load_depfile(depfile),
+                   desc=f'Compiling {shortcut}',
+                   shortcut=shortcut)
+        compile_steps.append((r.steps[-1], inputs, depfile, mtime_ns(depfile)))
+        ninja_edges.append((r.steps[-1], compiler_launcher + [executable, *args], str(obj.source.path), depfile))
         r.generated.add(obj.path)
-        compilation_db.append(
-            CompilationEntry(str(obj.source.path), str(obj.path), pargs))
+        r.generated.add(depfile)
+        compilation_db.append({
+            'directory': directory,
+            'file': str(obj.source.path),
+            'output': str(obj.path),
+            'arguments': [compiler_name, *args],
+        })
     for bin in bins:
-        pargs = [compiler]
-        pargs += [str(obj.path) for obj in bin.objects]
-        pargs += bin.build_type.LDFLAGS()
-        pargs += bin.link_args
-        pargs += ['-o', str(bin.path)]
-        builder = functools.partial(make.Popen, pargs)
+        objects = [str(obj.path) for obj in bin.objects]
+        flags = [*bin.build_type.LDFLAGS(), *bin.link_args, '-o', str(bin.path)]
+        pargs = [compiler_path, *objects, *flags]
+        # Linker errors are demangled & printed as soon as they appear
+        rsp_path = Path(f'{bin.path}.rsp')
+        builder = functools.partial(link, [compiler_path, *flags], objects, rsp_path)
         r.add_step(builder,
                    outputs=[bin.path],
                    inputs=bin.objects,
                    desc=f'Linking {bin.path.name}',
                    shortcut=f'link {bin.path.name}')
+        ninja_edges.append((r.steps[-1], pargs, None, None))
         r.generated.add(bin.path)
+        r.generated.add(rsp_path)
 
         # if platform == 'win32':
         #     MT = 'C:\\Program Files (x86)\\Windows Kits\\10\\bin\\10.0.19041.0\\x64\\mt.exe'
@@ -305,30 +632,112 @@ def recipe() -> make.Recipe:
                    desc=f'Running {bin.path.name}',
                    shortcut=bin.path.name)
 
+        if llvm_bolt and bin.build_type == release:
+            instrumented = Path(f'{bin.path}.inst')
+            profile = Path(f'{bin.path}.fdata')
+            optimized = Path(f'{bin.path}.bolt')
+            r.add_step(functools.partial(make.Popen, [llvm_bolt, bin.path, '-instrument',
+                                                      f'-instrumentation-file={profile}', '-o', instrumented]),
+                       outputs=[instrumented],
+                       inputs=[bin.path],
+                       desc=f'Instrumenting {bin.path.name}',
+                       shortcut=instrumented.name)
+            # The profile is written when the instrumented binary exits
+            r.add_step(functools.partial(make.Popen, [instrumented] + bin.run_args),
+                       outputs=[profile],
+                       inputs=[instrumented],
+                       desc=f'Training {bin.path.name}',
+                       shortcut=profile.name)
+            r.add_step(functools.partial(make.Popen, [llvm_bolt, bin.path, f'-data={profile}',
+                                                      '-reorder-blocks=ext-tsp', '-reorder-functions=hfsort',
+                                                      '-split-functions', '-icf=1', '-o', optimized]),
+                       outputs=[optimized],
+                       inputs=[bin.path, profile],
+                       desc=f'Optimizing {bin.path.name} with BOLT',
+                       shortcut=optimized.name)
+            r.generated.update([instrumented, profile, optimized])
+
     for ext in extensions:
         if hasattr(ext, 'hook_final'):
             ext.hook_final(srcs, objs, bins, r)
 
     def compile_commands():
-        jsons = []
-        for entry in compilation_db:
-            arguments = ',\n    '.join(
-                json.dumps(str(arg)) for arg in entry.arguments)
-            json_entry = f'''{{
-  "directory": { json.dumps(str(fs_utils.project_root)) },
-  "file": { json.dumps(entry.file) },
-  "output": { json.dumps(entry.output) },
-  "arguments": [{arguments}]
-}}'''
-            jsons.append(json_entry)
-        with open('compile_commands.json', 'w') as f:
-            print('[' + ', '.join(jsons) + ']', file=f)
-
-    r.add_step(compile_commands, ['compile_commands.json'], [],
+        entries = sorted(compilation_db, key=lambda entry: (entry['file'], entry['output']))
+        # Compact separators & no indentation - indentation would make `json` fall back to its pure-Python encoder.
+        # Rewriting an identical file would make all of the objects (and clangd) think that the flags changed.
+        fs_utils.write_if_changed(Path('compile_commands.json'), json.dumps(entries, separators=(',', ':')))
+
+    # Compilation flags come from the build scripts and from the pragmas in the (non-generated) sources
+    generated_prefix = str(fs_utils.generated_dir) + os.sep
+    compile_commands_inputs = [path for path in srcs if not path.startswith(generated_prefix)]
+    compile_commands_inputs += fs_utils.relative_to_root(Path(__file__).parent).glob('*.py')
+    compile_commands_inputs += fs_utils.relative_to_root(fs_utils.src_dir).glob('*.py')
+    r.add_step(compile_commands, ['compile_commands.json'], compile_commands_inputs,
                desc='Writing JSON Compilation Database',
                shortcut='compile_commands.json')
     r.generated.add('compile_commands.json')
 
+    def build_ninja():
+        writer = ninja.Writer()
+        writer.comment('Generated by `run build.ninja`. Compiles & links the binaries without the Python scheduler:')
+        writer.comment(f'  ninja -f {NINJA_FILE} <binary>')
+        writer.comment('Generated sources & third-party libraries are built by the Python recipe before this file is written.')
+        writer.variable('ninja_required_version', '1.3')
+        writer.variable('builddir', str(fs_utils.build_dir))
+        # No `deps = gcc` - Ninja would move the depfiles into `.ninja_deps` but the object cache & `update` read them
+        writer.rule('cc', command='$cmd', depfile='$depfile', description='Compiling $out')
+        writer.rule('link', command='$cmd', description='Linking $out')
+        for step, command, source, depfile in ninja_edges:
+            if source:
+                writer.build(sorted(step.outputs), 'cc', [source], sorted(step.inputs - {source}),
+                             cmd=ninja.command_line(command), depfile=ninja.escape_path(depfile))
+            else:
+                writer.build(sorted(step.outputs), 'link', sorted(link_inputs[step]), cmd=ninja.command_line(command))
+        fs_utils.write_if_changed(NINJA_FILE, writer.text())
+
+    # Everything that the Ninja edges need (apart from their own outputs) must exist before Ninja runs
+    ninja_outputs = set().union(*(step.outputs for step, *_ in ninja_edges))
+    ninja_inputs = set().union(*(step.inputs for step, *_ in ninja_edges)) - ninja_outputs
+    # Inputs of the link edges - taken before the link steps are handed over to Ninja
+    link_inputs = {step: step.inputs for step, _, source, _ in ninja_edges if not source}
+    r.add_step(build_ninja, [NINJA_FILE], ninja_inputs,
+               desc='Writing build.ninja',
+               shortcut='build.ninja')
+
+    def run_ninja(outputs):
+        # The file is written here rather than by depending on the `build.ninja` step - that one needs the inputs of
+        # all the build types
+        build_ninja()
+        return make.Popen(ninja_command + outputs, stderr_prettifier=cxxfilt.cxxfilt)
+
+    ninja_links.clear()
+    if ninja_path:
+        compile_step_of = {output: step for step, _, source, _ in ninja_edges if source for output in step.outputs}
+        for step, _, source, _ in ninja_edges:
+            if source:
+                continue
+            compiles = [compile_step_of[x] for x in step.inputs if x in compile_step_of]
+            ninja_links.append((step, link_inputs[step], compiles))
+            step.build = functools.partial(run_ninja, sorted(step.outputs))
+            # Parallel Ninja runs would share `.ninja_log` & compile the common objects at the same time. Each run
+            # gets the whole `-j` instead.
+            step.serial = 'ninja'
+        update_ninja_links()
+    r.generated.add(NINJA_FILE)
+    r.generated.add(THINLTO_CACHE)
+
+    if pgo_use:
+        def merge_pgo_profiles():
+            return make.Popen([llvm_profdata, 'merge', '-o', PGO_PROFILE] + sorted(PGO_DIR.glob('*.profraw')))
+
+        # The instrumented binaries add new raw profiles to `PGO_DIR` (changing its mtime)
+        r.add_step(merge_pgo_profiles, [PGO_PROFILE], [PGO_DIR],
+                   desc='Merging PGO profiles',
+                   shortcut='pgo')
+        r.generated.add(PGO_PROFILE)
+    r.generated.add(OBJ_CACHE)
+    prune_obj_cache()
+
     def deploy():
         return make.Popen(['rsync', '--protect-args', '-av', '--delete', '--exclude', 'builds', '--exclude', 'assets', '-og', '--chown=maf:www-data', 'www/', 'protectli:/var/www/automat.org/'], shell=False)
 
@@ -337,3 +746,20 @@ def recipe() -> make.Recipe:
 
 
     return r
+
+
+def update(r: make.Recipe, changed: set[str]) -> make.Recipe:
+    '''Returns the recipe for the next build, after the `changed` files were modified.
+
+    Usually only the code of some files changes. Their scan results stay the same so `r` is reused - only the
+    inputs from the depfiles written by the last build are refreshed. Otherwise the whole recipe is constructed
+    again (with the unchanged files taken from the last scan).'''
+    if src.rescan(changed):
+        return recipe()
+    for i, (step, inputs, depfile, old_mtime_ns) in enumerate(compile_steps):
+        new_mtime_ns = mtime_ns(depfile)
+        if new_mtime_ns != old_mtime_ns:
+            step.inputs = inputs | load_depfile(depfile)
+            compile_steps[i] = (step, inputs, depfile, new_mtime_ns)
+    update_ninja_links()
+    return r
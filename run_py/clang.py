@@ -1,10 +1,33 @@
-import subprocess
-
-
-def query_default_defines() -> set[str]:
-    result = subprocess.run(['clang', '-dM', '-E', '-'],
-                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
-    return set([line.split()[1] for line in result.stdout.decode().splitlines()])
-
-
-default_defines = query_default_defines()
+import fs_utils
+import json
+import os
+import subprocess
+
+# Output of `query_default_defines`, together with the clang executable that it came from
+DEFINES_CACHE = fs_utils.build_dir / 'clang_defines.json'
+
+
+def query_default_defines() -> set[str]:
+    '''Macros predefined by clang. Running the preprocessor is skipped while the clang executable stays the same.'''
+    executable = fs_utils.which('clang') or 'clang'
+    try:
+        st = os.stat(executable)
+        key = [executable, st.st_mtime_ns, st.st_size]
+    except OSError:
+        key = None
+    try:
+        cache = json.loads(DEFINES_CACHE.read_text())
+        if key and cache['key'] == key:
+            return set(cache['defines'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    result = subprocess.run([executable, '-dM', '-E', '-'],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    defines = {line.split(maxsplit=2)[1] for line in result.stdout.decode().splitlines() if line}
+    if key and result.returncode == 0:
+        DEFINES_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        fs_utils.write_if_changed(DEFINES_CACHE, json.dumps({'key': key, 'defines': sorted(defines)}))
+    return defines
+
+
+default_defines = query_default_defines()
@@ -11,7 +11,8 @@ build.fast.CMAKE_MSVC_RUNTIME_LIBRARY = 'MultiThreaded'
 build.release.CMAKE_MSVC_RUNTIME_LIBRARY = 'MultiThreaded'
 build.debug.CMAKE_MSVC_RUNTIME_LIBRARY = 'MultiThreadedDebug'
 
-def CMakeArgs(build_type: build.BuildType):
+def CMakeArgs(build_type: build.BuildType, unity_build=True):
+    '''Arguments for configuring a CMake project. Pass `unity_build=False` for projects that break in unity builds.'''
     CMAKE_BUILD_TYPE = build_type.CMAKE_BUILD_TYPE
     CMAKE_MSVC_RUNTIME_LIBRARY = build_type.CMAKE_MSVC_RUNTIME_LIBRARY
 
@@ -20,4 +21,14 @@ def CMakeArgs(build_type: build.BuildType):
 
     cmake_args += ['-DCMAKE_POLICY_DEFAULT_CMP0091=NEW', f'-D{CMAKE_MSVC_RUNTIME_LIBRARY=}']
 
+    # Third-party libraries are compiled through the same compiler cache as Automat's own sources
+    if build.compiler_launcher:
+        launcher = ';'.join(build.compiler_launcher)
+        cmake_args += [f'-DCMAKE_C_COMPILER_LAUNCHER={launcher}', f'-DCMAKE_CXX_COMPILER_LAUNCHER={launcher}']
+
+    # Unity builds compile batches of sources as single translation units so the headers are parsed less often.
+    # Debug builds are left alone - errors & debug info should point at the individual files.
+    if unity_build and build_type != build.debug:
+        cmake_args += ['-DCMAKE_UNITY_BUILD=ON', '-DCMAKE_UNITY_BUILD_BATCH_SIZE=16']
+
     return cmake_args
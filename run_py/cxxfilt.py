@@ -0,0 +1,81 @@
+'''Demangles C++ symbols that show up in linker errors.'''
+
+import atexit
+import functools
+import fs_utils
+import re
+import threading
+from subprocess import Popen, DEVNULL, PIPE
+
+CXXFILT = 'llvm-cxxfilt'
+
+cxx_identifier_re = re.compile(r'(_Z[a-zA-Z0-9_]+)')
+
+# Long-lived `llvm-cxxfilt` that demangles the names written to its STDIN (one per line)
+_process: Popen | None = None
+# Link steps print their errors from separate threads
+_lock = threading.Lock()
+
+
+def _stop():
+    if _process:
+        _process.terminate()
+
+
+atexit.register(_stop)
+
+
+@functools.lru_cache(maxsize=4096)
+def demangle(symbol: str) -> str:
+    '''Returns the demangled form of `symbol` (or `symbol` itself if it can't be demangled).'''
+    global _process
+    with _lock:
+        if _process is None or _process.poll() is not None:
+            if not (executable := fs_utils.which(CXXFILT)):
+                return symbol
+            _process = Popen([executable], stdin=PIPE, stdout=PIPE, stderr=DEVNULL, text=True, bufsize=1)
+        try:
+            _process.stdin.write(symbol + '\n')
+            _process.stdin.flush()
+            demangled = _process.stdout.readline()
+        except BrokenPipeError:
+            return symbol
+    return demangled.rstrip('\n') or symbol
+
+
+def collapse_self_bracket(line: str) -> str:
+    '''Replaces every "X[X]" in `line` with "X".
+
+    Brackets are paired up in a single pass so the cost is linear in the length of the line.'''
+    closing = {}
+    stack = []
+    for i, c in enumerate(line):
+        if c == '[':
+            stack.append(i)
+        elif c == ']' and stack:
+            closing[stack.pop()] = i
+    parts = []
+    pos = 0  # start of the text that wasn't copied to `parts` yet
+    for i in sorted(closing):
+        if i < pos:  # nested in a bracket that was already removed
+            continue
+        j = closing[i]
+        inner = line[i + 1:j]
+        if inner and '\n' not in inner and line.endswith(inner, pos, i):
+            parts.append(line[pos:i])
+            pos = j + 1
+    if not parts:
+        return line
+    parts.append(line[pos:])
+    return ''.join(parts)
+
+
+@functools.lru_cache(maxsize=4096)
+def cxxfilt(line: str) -> str:
+    '''Replaces all mangled identifiers in `line` with their demangled forms.
+
+    Identifiers are demangled by a single `llvm-cxxfilt` process that is shared by the whole build.
+    Linker errors tend to repeat the same lines so the results are cached.'''
+    line = cxx_identifier_re.sub(lambda m: demangle(m.group(1)), line)
+    # lld sometimes prints symbols as "mangled[demangled]" which turns into "X[X]" after demangling
+    return collapse_self_bracket(line)
@@ -1,23 +1,44 @@
 '''This module ensures that all of the necessary Debian dependencies are installed.'''
 
 import os
-from subprocess import run
+from subprocess import run, DEVNULL, PIPE
 from sys import platform
 
 path_to_package = {
     "/usr/include/zlib.h": "zlib1g-dev",
     "/usr/include/openssl/ssl.h": "libssl-dev",
-    "/usr/bin/inotifywait": "inotify-tools",
     "/usr/include/gmock": "libgmock-dev",
 }
 
 
+def installed_packages() -> set[str]:
+    '''Names of all packages installed on the system. Empty if `dpkg-query` is not available.'''
+    try:
+        result = run(['dpkg-query', '-W', '-f', '${Package} ${db:Status-Abbrev}\n'],
+                     stdout=PIPE, stderr=DEVNULL, text=True)
+    except FileNotFoundError:  # non-Debian system
+        return set()
+    installed = set()
+    for line in result.stdout.splitlines():
+        package, _, status = line.partition(' ')
+        if status.startswith('ii'):
+            installed.add(package)
+    return installed
+
+
 def check_and_install():
     if platform != 'linux':
         return
+    # Usually everything is in place - checking the paths costs a few `stat` calls so `dpkg-query` runs only when
+    # some of them are missing
+    missing_paths = [path for path in path_to_package if not os.path.exists(path)]
+    if not missing_paths:
+        return
+    installed = installed_packages()
     missing_packages = set()
-    for path, package in path_to_package.items():
-        if not os.path.exists(path):
+    for path in missing_paths:
+        package = path_to_package[path]
+        if package not in installed:
             missing_packages.add(package)
     if missing_packages:
         print("Some packages are missing from your system. Will try to install them automatically:\n")
@@ -1,6 +1,9 @@
 '''Utilities for operating on filesystem.'''
 
 from pathlib import Path
+import functools
+import os
+import shutil
 
 project_root = Path(__file__).resolve().parents[1]
 project_name = Path(project_root).name.lower()
@@ -13,3 +16,40 @@ def relative_to_root(path: Path) -> Path:
 build_dir = relative_to_root(project_root / 'build')
 src_dir = project_root / 'src'
 generated_dir = relative_to_root(build_dir / 'generated')
+
+
+def walk(root: Path, extensions: tuple[str, ...]):
+    '''Recursively yields files under `root` whose names end with one of `extensions`.
+
+    This is a single `os.scandir` pass over the tree. File types come from the directory entries so
+    (unlike `Path.glob`) no `stat` is needed for each file.'''
+    dirs = [root]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.name.endswith(extensions):
+                    yield Path(entry.path)
+
+
+def write_if_changed(path: Path, text: str) -> bool:
+    '''Writes `text` to `path` unless the file already has exactly this content.
+
+    Keeping the old file (and its mtime) avoids rebuilding everything that depends on it.
+    Returns True if the file was written.'''
+    try:
+        if path.read_text() == text:
+            return False
+    except FileNotFoundError:
+        pass
+    path.write_text(text)
+    return True
+
+
+@functools.cache
+def which(tool: str):
+    '''Returns the absolute path of `tool` (or None if it can't be found).
+
+    Each tool is looked up in `PATH` only once - later calls (from any module) hit the cache.'''
+    return shutil.which(tool)
@@ -0,0 +1,104 @@
+'''In-process file watcher based on Linux inotify.'''
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.inotify_init1.argtypes = [ctypes.c_int]
+_libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+# struct inotify_event (without the trailing name)
+_event_header = struct.Struct('iIII')
+
+
+def _check(result: int) -> int:
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Watcher:
+    '''Watches directories for changes. Provides the parts of `subprocess.Popen` that are used by the build loop.
+
+    The inotify descriptor lives for as long as the watcher so events that happen during a build are never lost.'''
+
+    # Not a process. `make.Recipe.execute` reports this PID when the watcher fires.
+    pid = -1
+
+    # Editors & formatters often save several files at once. `wait` returns only after no events arrived for
+    # `coalesce_delay` seconds (but no later than `coalesce_limit` seconds after the first change).
+    coalesce_delay = 0.05
+    coalesce_limit = 1.0
+
+    def __init__(self, dirs, mask=IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE, suffixes=('',)):
+        '''Only the files whose names end with one of `suffixes` are reported.
+
+        The default `mask` catches files saved in place and files replaced by renaming (the way many editors save
+        them), as well as removed files. Creating a file is reported once it's written.'''
+        self.fd = _check(_libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.dirs: dict[int, str] = dict()  # watch descriptor -> directory
+        self.suffixes = tuple(suffixes)
+        self.pending: set[str] = set()  # changes read by `poll` but not returned by `wait` yet
+        for d in dirs:
+            wd = _check(_libc.inotify_add_watch(self.fd, os.fsencode(d), mask))
+            self.dirs[wd] = str(d)
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def poll(self):
+        '''Returns 0 if some files have changed since the last `wait`, None otherwise.'''
+        self.pending |= self.read()
+        return 0 if self.pending else None
+
+    def wait(self) -> set[str]:
+        '''Blocks until something changes. Returns the paths of all the changes that happened since the last call.'''
+        while not self.pending:
+            select.select([self.fd], [], [])
+            self.pending |= self.read()
+        deadline = time.monotonic() + self.coalesce_limit
+        while (timeout := min(self.coalesce_delay, deadline - time.monotonic())) > 0:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                break
+            self.pending |= self.read()
+        changed, self.pending = self.pending, set()
+        return changed
+
+    def read(self) -> set[str]:
+        '''Consumes the pending events (without blocking) and returns the changed paths.'''
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            except OSError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, name_len = _event_header.unpack_from(buf, offset)
+                offset += _event_header.size
+                name = os.fsdecode(buf[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+                if wd in self.dirs and name.endswith(self.suffixes):
+                    changed.add(os.path.join(self.dirs[wd], name))
+
+    def kill(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
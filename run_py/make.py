@@ -3,13 +3,16 @@
 from pathlib import Path
 from collections import defaultdict
 from sys import platform
+import sys
 import time
-import multiprocessing
 import os
 import subprocess
 import signal
+import stat
 import shutil
 import tempfile
+import select
+import threading
 import hashlib
 import fs_utils
 import args as cmdline_args
@@ -21,12 +24,27 @@ HASH_DIR = fs_utils.build_dir / 'hashes'
 HASH_DIR.mkdir(parents=True, exist_ok=True)
 
 
-def Popen(args, **kwargs):
-    '''Wrapper around subprocess.Popen which captures STDERR into a temporary file.'''
-    f = tempfile.TemporaryFile()
+def Popen(args, stderr_prettifier=None, **kwargs):
+    '''Wrapper around subprocess.Popen which captures STDERR into a temporary file.
+
+    When `stderr_prettifier` is given, STDERR is instead printed while the process runs - line by line, passed
+    through the prettifier. This is done by a thread which is available as `stderr_thread`.'''
     str_args = [str(x) for x in args]
     if cmdline_args.args.verbose:
         print(' $ \033[90m' + ' '.join(str_args) + '\033[0m')
+    if platform != 'win32':
+        # File descriptors opened by Python (and by this build system) are not inheritable so there is nothing to
+        # close. Without `close_fds` (and given an executable path with a directory) CPython uses `posix_spawn`.
+        kwargs.setdefault('close_fds', False)
+    if stderr_prettifier:
+        p = subprocess.Popen(str_args,
+                             stdin=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE,
+                             **kwargs)
+        p.stderr_thread = threading.Thread(target=print_lines, args=(p.stderr, stderr_prettifier), daemon=True)
+        p.stderr_thread.start()
+        return p
+    f = tempfile.TemporaryFile()
     p = subprocess.Popen(str_args,
                          stdin=subprocess.DEVNULL,
                          #stdout=f,
@@ -36,16 +54,62 @@ def Popen(args, **kwargs):
     return p
 
 
+def print_lines(stream, prettifier):
+    for line in stream:
+        sys.stderr.write('  ' + prettifier(line.decode('utf-8', errors='replace').rstrip('\n')) + '\n')
+        sys.stderr.flush()
+
+
+# pidfds let `Recipe.execute` wait for the running steps and the file watcher at the same time (Linux 5.3+)
+use_pidfd = platform == 'linux' and hasattr(os, 'pidfd_open')
+
+
+def available_cpus() -> int:
+    '''Number of CPUs that this process may run on (may be limited by affinity masks / cpusets).'''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# Maps paths to (mtime, size, digest). Many steps share the same inputs (headers) so their hashes are
+# computed only once - unless the file is modified in the meantime.
+_digests: dict[str, tuple[int, int, str]] = dict()
+
+
 def hexdigest(path):
-    path = Path(path)
-    if path.exists():
-        if path.is_dir():
-            contents = path.stat().st_mtime_ns.to_bytes(8, 'big')
-        else:
-            contents = path.read_bytes()
+    path = str(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return hashlib.blake2b(b'', digest_size=16).hexdigest()
+    cached = _digests.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    if stat.S_ISDIR(st.st_mode):
+        contents = st.st_mtime_ns.to_bytes(8, 'big')
     else:
-        contents = b''
-    return hashlib.md5(contents).hexdigest()
+        contents = Path(path).read_bytes()
+    digest = hashlib.blake2b(contents, digest_size=16).hexdigest()
+    _digests[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+# Results of `os.stat` (None for missing files) made during the current `Recipe.execute`. Steps share most of their
+# inputs (headers) so each one is checked only once. Outputs of a step are forgotten when the step finishes.
+_stats: dict[str, os.stat_result | None] = dict()
+
+
+def cached_stat(path: str) -> os.stat_result | None:
+    try:
+        return _stats[path]
+    except KeyError:
+        pass
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    _stats[path] = st
+    return st
 
 
 class Step:
@@ -57,7 +121,8 @@ class Step:
                  id,
                  desc=None,
                  shortcut=None,
-                 stderr_prettifier=lambda x: x):
+                 stderr_prettifier=lambda x: x,
+                 serial=None):
         if not desc:
             desc = f'Running {build_func.__name__}'
         if not shortcut:
@@ -72,6 +137,7 @@ class Step:
         self.builder = None  # Popen instance while this step is being built
         self.id = id
         self.stderr_prettifier = stderr_prettifier
+        self.serial = serial  # steps with the same (non-None) `serial` never run at the same time
 
     def __repr__(self):
         return f'{self.desc}'
@@ -87,23 +153,16 @@ class Step:
 
     def dirty_inputs(self):
         # Check 1: If the output doesn't exist, report that all inputs have changed.
-        for out in self.outputs:
-            if not Path(out).exists():
-                return self.inputs
+        output_stats = [cached_stat(out) for out in self.outputs]
+        if None in output_stats:
+            return self.inputs
 
         # Check 2: Check whether the inputs are older than outputs.
-        if self.outputs:
-            build_time = min(
-                Path(t).stat().st_mtime if Path(t).exists() else 0
-                for t in self.outputs)
-        else:
-            build_time = 0
+        build_time = min((st.st_mtime for st in output_stats), default=0)
         updated_inputs = []
         for inp in self.inputs:
-            p = Path(inp)
-            if p.exists() and p.stat().st_mtime < build_time:
-                continue
-            if not p.exists():
+            st = cached_stat(inp)
+            if st is None or st.st_mtime < build_time:
                 continue
             updated_inputs.append(inp)
 
@@ -125,7 +184,7 @@ class Step:
         return changed_inputs
 
     def build_if_needed(self):
-        if len(self.inputs) == 0 and any(not Path(out).exists()
+        if len(self.inputs) == 0 and any(cached_stat(out) is None
                                          for out in self.outputs):
             return self.build_and_log([])
         updated_inputs = self.dirty_inputs()
@@ -206,46 +265,71 @@ class Recipe:
 
     def execute(self, watcher):
         start_time = time.time()
-        desired_parallelism = multiprocessing.cpu_count()
+        desired_parallelism = cmdline_args.args.jobs or available_cpus()
+        _stats.clear()
         ready_steps = []
 
+        producers: dict[str, list[Step]] = defaultdict(list)
         for step in self.steps:
-            step.blocker_count = 0
+            for output in step.outputs:
+                producers[output].append(step)
 
+        # Steps that consume the outputs of a given step - in the order of `self.steps`
+        dependents: dict[Step, list[Step]] = {step: [] for step in self.steps}
         for a in self.steps:
-            for b in self.steps:
-                if b.outputs & a.inputs:
-                    a.blocker_count += 1
+            blockers = set()
+            for input in a.inputs:
+                blockers.update(producers.get(input, ()))
+            a.blocker_count = len(blockers)
+            for b in blockers:
+                dependents[b].append(a)
             if a.blocker_count == 0:
                 ready_steps.append(a)
 
         def on_step_finished(a):
+            for output in a.outputs:
+                _stats.pop(output, None)
             a.record_input_hashes()
-            for b in self.steps:
-                if b.inputs & a.outputs:
-                    b.blocker_count -= 1
-                    if b.blocker_count == 0:
-                        ready_steps.append(b)
+            for b in dependents[a]:
+                b.blocker_count -= 1
+                if b.blocker_count == 0:
+                    ready_steps.append(b)
+
+        watched = [watcher]  # emptied once a change is reported in non-live mode
+
+        busy_serial = set()  # `serial` of the running steps
+        deferred_steps = []  # ready steps waiting until their `serial` isn't busy
 
         def check_for_pid():
             for pid, step in self.pid_to_step.items():
                 status = step.builder.poll()
                 if status != None:
                     return pid, status
-            status = watcher.poll()
-            if status != None:
-                return watcher.pid, status
+            if watched:
+                status = watcher.poll()
+                if status != None:
+                    return watcher.pid, status
             return 0, 0
 
         def wait_for_pid():
-            if platform == 'win32':
+            if platform == 'win32' or not use_pidfd:
                 while True:
                     pid, status = check_for_pid()
                     if pid:
                         return pid, status
                     time.sleep(0.01)
             else:
-                return os.wait()
+                # Sleep until one of the running steps finishes or the watcher reports a change
+                pidfds = {step.builder.pidfd: pid for pid, step in self.pid_to_step.items()}
+                while True:
+                    readable, _, _ = select.select(list(pidfds) + watched, [], [])
+                    for fd in readable:
+                        if fd in pidfds:
+                            os.close(fd)
+                            self.pid_to_step[pidfds[fd]].builder.pidfd = -1
+                            return os.waitpid(pidfds[fd], 0)
+                    if watcher.poll() is not None:  # the events may concern unrelated files
+                        return watcher.pid, 0
 
         while ready_steps or self.pid_to_step:
             if len(ready_steps) == 0 or len(
@@ -266,16 +350,21 @@ class Recipe:
                             return False
                         else:
                             print('Sources have been modified but the build is not in live mode. Continuing the build...')
+                            watched.clear()
                             continue
                     break
                 step = self.pid_to_step[pid]
+                if stderr_thread := getattr(step.builder, 'stderr_thread', None):
+                    stderr_thread.join()  # wait until the whole STDERR is printed
                 if status:
                     print(f'{step.desc} finished with an error:\n')
                     if hasattr(step.builder, 'args'):
                         orig_command = ' > \033[90m' + \
                             ' '.join(step.builder.args) + '\033[0m\n'
                         print(orig_command)
-                    if step.builder.stderr:
+                    if stderr_thread:
+                        pass  # STDERR was already printed while the step was running
+                    elif step.builder.stderr:
                         step.builder.stderr.seek(0)
                         stderr = step.builder.stderr.read().decode('utf-8')
                         for line in stderr.split('\n'):
@@ -284,16 +373,29 @@ class Recipe:
                         print('  (no stderr)')
                     self.interrupt()
                     return False
+                if on_success := getattr(step.builder, 'on_success', None):
+                    on_success()
                 step.builder = None
                 del self.pid_to_step[pid]
+                if step.serial:
+                    busy_serial.discard(step.serial)
+                    ready_steps.extend(deferred_steps)
+                    deferred_steps.clear()
                 on_step_finished(step)
             else:
                 next = ready_steps.pop()
+                if next.serial in busy_serial:
+                    deferred_steps.append(next)
+                    continue
                 try:
                     builder = next.build_if_needed()
                     if builder:
+                        if next.serial:
+                            busy_serial.add(next.serial)
                         next.builder = builder
                         self.pid_to_step[builder.pid] = next
+                        if use_pidfd:
+                            builder.pidfd = os.pidfd_open(builder.pid)
                     else:
                         on_step_finished(next)
                 except subprocess.CalledProcessError as err:
@@ -313,6 +415,10 @@ class Recipe:
         start_time = time.time()
         deadline = start_time + 3
         active = [step.builder for step in self.steps if step.builder]
+        for task in active:
+            if getattr(task, 'pidfd', -1) >= 0:
+                os.close(task.pidfd)
+                task.pidfd = -1
         if platform == 'win32':
             # Plan:
             # For each process, get its PID. Then find it's HWND and send a WM_CLOSE message.
@@ -330,3 +436,7 @@ class Recipe:
                     pass # wait for other tasks before killing
         for task in active:
             task.kill()
+        # The recipe may be executed again (see `build.update`)
+        for step in self.steps:
+            step.builder = None
+        self.pid_to_step.clear()
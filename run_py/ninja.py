@@ -0,0 +1,47 @@
+'''Writer for Ninja build files (https://ninja-build.org/manual.html).'''
+
+import shlex
+import subprocess
+from sys import platform
+
+
+def escape_path(path) -> str:
+    return str(path).replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+
+def command_line(args) -> str:
+    '''Joins `args` into a shell command & escapes it for Ninja.'''
+    if platform == 'win32':
+        command = subprocess.list2cmdline([str(x) for x in args])
+    else:
+        command = shlex.join(str(x) for x in args)
+    return command.replace('$', '$$')
+
+
+class Writer:
+    def __init__(self):
+        self.lines: list[str] = []
+
+    def comment(self, text: str):
+        self.lines.append(f'# {text}')
+
+    def variable(self, name: str, value: str, indent=0):
+        self.lines.append(f'{"  " * indent}{name} = {value}')
+
+    def rule(self, name: str, **variables):
+        self.lines.append(f'rule {name}')
+        for key, value in variables.items():
+            self.variable(key, value, indent=1)
+
+    def build(self, outputs, rule: str, inputs=(), implicit=(), **variables):
+        line = f'build {" ".join(escape_path(x) for x in outputs)}: {rule}'
+        if inputs:
+            line += ' ' + ' '.join(escape_path(x) for x in inputs)
+        if implicit:
+            line += ' | ' + ' '.join(escape_path(x) for x in implicit)
+        self.lines.append(line)
+        for key, value in variables.items():
+            self.variable(key, value, indent=1)
+
+    def text(self) -> str:
+        return '\n'.join(self.lines) + '\n'
@@ -1,21 +1,48 @@
 '''Functions related to the `src/` directory.'''
 
+from array import array
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from types import ModuleType
 import clang
+import copy
 import fs_utils
+import hashlib
 import importlib.util
+import mmap
+import os
+import pickle
 import re
 import sys
 
+# All of the lines that the scanner is interested in - matched in a single pass over the file.
+# The name of the last group in each alternative identifies the kind of line (`match.lastgroup`).
+scan_re = re.compile(rb'''^(?:
+    # This regular experession captures most of #if defined/#ifdef variants (and their #elif versions) in one go.
+    # ?: at the beginning of a group means that it's non-capturing
+    # ?P<...> ate the beginning of a group assigns it a name
+    \#(?P<el>el)?if(?P<neg1>n)?(?:def)?\ ?(?P<neg2>!)?(?:defined)?(?:\()?(?P<id>[a-zA-Z0-9_]+)?(?P<if>\)?)
+  | \#(?P<else>else)
+  | \#(?P<endif>endif)
+  | \#include\ <(?P<system_include>[a-zA-Z0-9_/\.-]+)>
+  | \#pragma\ comment\(lib,\ "(?P<comment_lib>[a-zA-Z0-9_/\.-]+)"\)
+  | \#include\ "(?P<include>[a-zA-Z0-9_/\.-]+\.hh?)"
+  | \#pragma\ maf\ add\ (?P<build_type>debug|release|fast|)\ ?(?P<target>link|compile|run)\ argument\ "(?P<arg>.+)"
+  | \#pragma\ maf\ (?P<main>main)
+)''', re.MULTILINE | re.VERBOSE)
+
+
+# Files that are scanned & compiled
+SOURCE_EXTENSIONS = ('.cc', '.hh', '.h', '.c')
+
 
 class File:
     path: Path
     system_includes: list[str]
     comment_libs: list[str]
     direct_includes: list[str]
-    transitive_includes: set['File']
+    transitive_includes: frozenset['File']
     link_args: dict[str, list[str]]
     compile_args: dict[str, list[str]]
     run_args: dict[str, list[str]]
@@ -30,7 +57,7 @@ class File:
         self.compile_args = defaultdict(list)
         self.run_args = defaultdict(list)
         self.main = False
-        self.transitive_includes = set()
+        self.transitive_includes = frozenset()
 
     def is_header(self) -> bool:
         return self.path.suffix in ('.h', '.hh')
@@ -54,94 +81,69 @@ class File:
         self.run_args.clear()
         self.main = False
 
-        if_stack = [True]
+        # Each entry is a pair of flags: [is the current branch active, was any branch of this #if active]
+        if_stack = [[True, True]]
         current_defines = clang.default_defines.copy()
 
-        for line in open(self.path, encoding='utf-8').readlines():
-
-            # Minimal preprocessor. This allows us to skip platform-specific imports.
-
-            # This regular experession captures most of #if defined/#ifdef variants in one go.
-            # ?: at the beginning of a group means that it's non-capturing
-            # ?P<...> ate the beginning of a group assigns it a name
-            match = re.match(
-                r'^#(?P<el>el(?P<else>se)?)?(?P<end>end)?if(?P<neg1>n)?(?:def)? ?(?P<neg2>!)?(?:defined)?(?:\()?(?P<id>[a-zA-Z0-9_]+)?(?:\))?', line)
-            if match:
-                test = match.group('id') in current_defines
-                if match.group('neg1') or match.group('neg2'):
-                    test = not test
-                if match.group('else'):
-                    test = not if_stack[-1]
-
-                if match.group('end'):  # endif
-                    if_stack.pop()
-                elif match.group('el'):  # elif
-                    if_stack[-1] = test
-                else:  # if
-                    if_stack.append(test)
-                continue
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return  # empty files can't be mmapped
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for match in scan_re.finditer(buf):
+                    kind = match.lastgroup
 
-            if not if_stack[-1]:
-                continue
+                    # Minimal preprocessor. This allows us to skip platform-specific imports.
+                    if kind == 'if':
+                        test = match.group('id') is not None and match.group('id').decode() in current_defines
+                        if match.group('neg1') or match.group('neg2'):
+                            test = not test
 
-            # Actual scanning starts here
-            match = re.match(r'^#include <([a-zA-Z0-9_/\.-]+)>', line)
-            if match:
-                # system include
-                self.system_includes.append(match.group(1))
-                continue
+                        if match.group('el'):  # elif
+                            branch = if_stack[-1]
+                            branch[0] = if_stack[-2][0] and not branch[1] and test
+                            branch[1] = branch[1] or branch[0]
+                        else:  # if
+                            active = if_stack[-1][0] and test
+                            if_stack.append([active, active])
+                        continue
+                    elif kind == 'else':
+                        branch = if_stack[-1]
+                        branch[0] = if_stack[-2][0] and not branch[1]
+                        branch[1] = True
+                        continue
+                    elif kind == 'endif':
+                        if_stack.pop()
+                        continue
 
-            match = re.match(r'^#pragma comment\(lib, "([a-zA-Z0-9_/\.-]+)"\)', line)
-            if match:
-                # extra library
-                self.comment_libs.append(match.group(1))
-                continue
+                    if not if_stack[-1][0]:
+                        continue
 
+                    # Actual scanning starts here
+                    if kind == 'system_include':
+                        self.system_includes.append(match.group(kind).decode())
+                    elif kind == 'comment_lib':
+                        # extra library
+                        self.comment_libs.append(match.group(kind).decode())
+                    elif kind == 'include':
+                        # relative to current source file
+                        dep = os.path.normpath(os.path.join(self.path.parent, match.group(kind).decode()))
+                        self.direct_includes.append(dep)
+                    elif kind == 'arg':
+                        build_type, target, arg = (x.decode() for x in match.group('build_type', 'target', 'arg'))
+                        if target == 'link':
+                            target_dict = self.link_args
+                        elif target == 'compile':
+                            target_dict = self.compile_args
+                        elif target == 'run':
+                            target_dict = self.run_args
+                        else:
+                            raise ValueError(f'Unknown target: [{target}] in [{match.group(0).decode()}]')
+                        target_dict[build_type].append(arg)
+                    elif kind == 'main':
+                        self.main = True
 
-            match = re.match(r'^#include \"([a-zA-Z0-9_/\.-]+\.hh?)\"', line)
-            if match:
-                # relative to current source file
-                dep = self.path.parent / match.group(1)
-                dep = fs_utils.relative_to_root(dep)  # normalize
-                self.direct_includes.append(str(dep))
-
-            match = re.match(
-                r'^#pragma maf add (?P<build_type>debug|release|fast|) ?(?P<target>link|compile|run) argument "(?P<arg>.+)"', line)
-            if match:
-                build_type, target, arg = match.groups()
-                if target == 'link':
-                    target_dict = self.link_args
-                elif target == 'compile':
-                    target_dict = self.compile_args
-                elif target == 'run':
-                    target_dict = self.run_args
-                else:
-                    raise ValueError(f'Unknown target: [{target}] in [{line}]')
-                target_dict[build_type].append(arg)
-
-            match = re.match(r'^#pragma maf main', line)
-            if match:
-                self.main = True
-
-    # This should be called after all files are scanned
-    def update_transitive_includes(self, srcs: dict[str, 'File']):
-        self.transitive_includes.clear()
-        include_queue: list[str] = list(self.direct_includes)
-        while include_queue:
-            path = include_queue.pop()
-            if path not in srcs:
-                print(
-                    f'Warning: {self.path.name} includes non-existent "{path}"')
-                continue
-            inc = srcs[path]
-            if inc in self.transitive_includes:
-                continue
-            self.transitive_includes.add(inc)
-            for sys in inc.system_includes:
-                if sys not in self.system_includes:
-                    self.system_includes.append(sys)
-            self.main = self.main or inc.main  # propagate `main` flag from headers to sources
-            include_queue.extend(inc.direct_includes)
+        # A header may be included from several #if branches - drop the repeated edges in one go
+        self.direct_includes = list(dict.fromkeys(self.direct_includes))
 
     def __str__(self) -> str:
         return str(self.path)
@@ -150,19 +152,214 @@ class File:
         return f'File({self.path})'
 
 
-def scan() -> dict[str, File]:
-    result = dict()
-    paths = []
-    for ext in ['.cc', '.hh', '.h', '.c']:
-        paths.extend(fs_utils.src_dir.glob(f'**/*{ext}'))
+def scan_file(path: Path) -> File:
+    '''Scans a single source file. This is executed in worker processes so it must stay at the top level.'''
+    file = File(path)
+    file.scan_contents()
+    return file
+
 
-    for path_abs in paths:
+# Scanning a single file takes ~0.1ms. Worker processes only pay off for large source trees.
+PARALLEL_SCAN_MIN_FILES = 1000
+
+
+# Results of the previous scans, prefixed with `scanner_key()`. Maps paths to `(mtime_ns, size, File)`.
+SCAN_CACHE = fs_utils.build_dir / 'scan.pickle'
+
+
+def scanner_key() -> bytes:
+    '''Hash of everything (apart from the scanned files) that affects the results of `scan`.'''
+    st = os.stat(__file__)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{st.st_mtime_ns} {st.st_size}\n'.encode())
+    h.update(' '.join(sorted(clang.default_defines)).encode())
+    return h.digest()
+
+
+def load_scan_cache(key: bytes) -> dict[str, tuple[int, int, File]]:
+    try:
+        with open(SCAN_CACHE, 'rb') as f:
+            if f.read(len(key)) == key:
+                return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    return {}
+
+
+# Results of the last `scan` in this process (same format as `SCAN_CACHE`). The files are kept unmodified -
+# `scan` returns deep copies so `update_transitive_includes` & the extension hooks (which modify the lists & dicts of
+# the files in place) don't leak into the next scan, `rescan` or `SCAN_CACHE`.
+scanned: dict[str, tuple[int, int, File]] = {}
+
+
+def scan() -> dict[str, File]:
+    '''Scans all of the files in `src/`. Files with the same mtime & size as in the previous scan are not read again.'''
+    key = scanner_key()
+    cache = scanned or load_scan_cache(key)
+    entries: dict[str, tuple[int, int, File]] = {}
+    stale: list[Path] = []
+    for path_abs in fs_utils.walk(fs_utils.src_dir, SOURCE_EXTENSIONS):
         path = path_abs.relative_to(fs_utils.project_root)
-        file = File(path)
-        result[str(path)] = file
-        file.scan_contents()
+        st = os.stat(path)
+        entry = cache.get(str(path))
+        if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+            entry = (st.st_mtime_ns, st.st_size, None)
+            stale.append(path)
+        entries[str(path)] = entry
+
+    workers = os.cpu_count() or 1
+    if workers > 1 and len(stale) >= PARALLEL_SCAN_MIN_FILES:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            files = list(executor.map(scan_file, stale, chunksize=16))
+    else:
+        files = map(scan_file, stale)
+    for file in files:
+        mtime_ns, size, _ = entries[str(file.path)]
+        entries[str(file.path)] = (mtime_ns, size, file)
+
+    if stale or len(entries) != len(cache):
+        SCAN_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = SCAN_CACHE.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(key)
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, SCAN_CACHE)
+    scanned.clear()
+    scanned.update(entries)
+    return {path: copy.deepcopy(entry[2]) for path, entry in entries.items()}
+
+
+def scan_results(file: File) -> tuple:
+    '''Everything that `File.scan_contents` extracts from a file.'''
+    return (file.system_includes, file.comment_libs, file.direct_includes, file.link_args, file.compile_args,
+            file.run_args, file.main)
+
+
+def rescan(paths) -> bool:
+    '''Updates the results of the last `scan` with the contents of the modified `paths`.
+
+    Returns True if the build graph may have changed (files were added, removed or their includes & pragmas
+    changed). Edits that only touch the code return False - the previous recipe is still valid then.'''
+    graph_changed = False
+    for path in paths:
+        path = os.path.normpath(path)
+        if path.endswith('.py'):
+            graph_changed = True  # extensions can modify anything
+            continue
+        if not path.endswith(SOURCE_EXTENSIONS):
+            continue
+        entry = scanned.get(path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            graph_changed |= entry is not None
+            continue
+        if entry is None:
+            graph_changed = True  # new file - picked up by the next `scan`
+            continue
+        if entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            continue
+        file = scan_file(Path(path))
+        scanned[path] = (st.st_mtime_ns, st.st_size, file)
+        graph_changed |= scan_results(file) != scan_results(entry[2])
+    return graph_changed
+
+
+# This should be called after all files are scanned
+def update_transitive_includes(srcs: dict[str, File]):
+    '''Fills `transitive_includes` of all files & propagates system includes and `main` flags from headers.
+
+    Files are numbered and the include graph is stored in CSR form - includes of file `i` are
+    `indices[indptr[i]:indptr[i + 1]]`. Include cycles are collapsed into strongly connected components with
+    Tarjan's algorithm. It emits the components in reverse topological order so the closure of each one can be
+    assembled from the already computed closures of the components that it includes.'''
+    files = list(srcs.values())
+    ids = {path: i for i, path in enumerate(srcs)}
+    indptr = array('i', [0])
+    indices = array('i')
+    for file in files:
+        for path in file.direct_includes:
+            if path in ids:
+                indices.append(ids[path])
+            else:
+                print(f'Warning: {file.path.name} includes non-existent "{path}"')
+        indptr.append(len(indices))
+
+    n = len(files)
+    index = array('i', [-1]) * n
+    lowlink = array('i', [0]) * n
+    on_stack = bytearray(n)
+    stack: list[int] = []
+    closure: list[frozenset[int] | None] = [None] * n
+    counter = 0
+
+    for root in range(n):
+        if index[root] >= 0:
+            continue
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = 1
+        work = [[root, indptr[root]]]  # DFS stack of [file, position of the next include to visit]
+        while work:
+            frame = work[-1]
+            v, pos = frame
+            if pos < indptr[v + 1]:
+                frame[1] = pos + 1
+                w = indices[pos]
+                if index[w] < 0:
+                    index[w] = lowlink[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = 1
+                    work.append([w, indptr[w]])
+                elif on_stack[w] and index[w] < lowlink[v]:
+                    lowlink[v] = index[w]
+                continue
+            work.pop()
+            if work and lowlink[v] < lowlink[work[-1][0]]:
+                lowlink[work[-1][0]] = lowlink[v]
+            if lowlink[v] != index[v]:
+                continue
+            component = []
+            while True:
+                w = stack.pop()
+                on_stack[w] = 0
+                component.append(w)
+                if w == v:
+                    break
+            reachable = set()
+            for w in component:
+                for x in indices[indptr[w]:indptr[w + 1]]:
+                    if closure[x] is not None:  # already finished component
+                        reachable.add(x)
+                        reachable.update(closure[x])
+            if len(component) > 1 or v in indices[indptr[v]:indptr[v + 1]]:
+                reachable.update(component)
+            reachable = frozenset(reachable)
+            includes = frozenset(files[x] for x in reachable)
+            for w in component:
+                closure[w] = reachable
+                files[w].transitive_includes = includes
+
+    own_system_includes = [file.system_includes for file in files]
+    own_main = [file.main for file in files]
+    for i, file in enumerate(files):
+        system_includes = dict.fromkeys(own_system_includes[i])
+        for x in closure[i]:
+            system_includes.update(dict.fromkeys(own_system_includes[x]))
+        file.system_includes = list(system_includes)
+        # propagate `main` flag from headers to sources
+        file.main = own_main[i] or any(own_main[x] for x in closure[i])
+
 
-    return result
+def extensions_key() -> tuple:
+    '''Identifies the current versions of the extensions (the `*.py` files in `src/`).'''
+    key = []
+    for path in sorted(fs_utils.src_dir.glob('*.py')):
+        st = os.stat(path)
+        key.append((path, st.st_mtime_ns, st.st_size))
+    return tuple(key)
 
 
 def load_extensions() -> list[ModuleType]:
@@ -3,9 +3,10 @@
 # Note: command for crushing png files
 # pngcrush -ow -rem alla -brute -reduce static/*
 
+import hashlib
+import io
 import re
 import fs_utils
-import cc_embed
 import make
 import src
 
@@ -13,8 +14,11 @@ from pathlib import Path
 from functools import partial
 
 
+non_identifier_re = re.compile(r'[^a-zA-Z0-9]')
+
+
 def slug_from_path(path):
-    return re.sub(r'[^a-zA-Z0-9]', '_', str(path))
+    return non_identifier_re.sub('_', str(path))
 
 
 def escape_string(s):
@@ -26,7 +30,7 @@ cc_path = fs_utils.generated_dir / 'embedded.cc'
 
 
 def gen(embedded_paths):
-    with hh_path.open('w') as hh:
+    with io.StringIO() as hh:
         print(f'''#pragma once
 #include <cstddef>
 #include <string_view>
@@ -44,33 +48,50 @@ extern std::unordered_map<maf::StrView, maf::fs::VFile*> index;
             print(f'extern maf::fs::VFile {slug};', file=hh)
         print(f'''
 }}  // namespace maf::embedded''', file=hh)
+        fs_utils.write_if_changed(hh_path, hh.getvalue())
 
-    with cc_path.open('w') as cc:
+    with io.StringIO() as cc:
         print(f'''#include "embedded.hh"
 
 using namespace std::string_literals;
 using namespace maf;
 using namespace maf::fs;
 
+// The files are copied into the object file by the assembler (`.incbin`) so the compiler doesn't have to parse
+// megabytes of string literals. Each file is followed by a NUL byte, like a string literal would be.
+// `.pushsection` & `.popsection` restore whatever section the compiler was emitting before the `__asm__` block.
+// ELF symbols also get their type & size so that profilers & BOLT treat them as data.
+#if defined(_WIN32)
+#define EMBEDDED_SECTION ".pushsection .rdata,\\"dr\\"\\n"
+#define EMBEDDED_TYPE(name)
+#define EMBEDDED_SIZE(name)
+#else
+#define EMBEDDED_SECTION ".pushsection .rodata\\n"
+#define EMBEDDED_TYPE(name) ".type " name ", %object\\n"
+#define EMBEDDED_SIZE(name) ".size " name ", . - " name "\\n"
+#endif
+
 namespace maf::embedded {{''',
               file=cc)
         for path in embedded_paths:
             slug = slug_from_path(path)
             escaped_path = escape_string(str(path))
+            incbin = escape_string(f'.incbin "{escape_string(path.as_posix())}"')
+            # The digest changes the preprocessed source whenever the file changes (this matters for ccache)
+            digest = hashlib.blake2b(path.read_bytes(), digest_size=16).hexdigest()
             print(f'''
+__asm__(EMBEDDED_SECTION
+        ".balign 16\\n"
+        EMBEDDED_TYPE("maf_embedded_{slug}")
+        "maf_embedded_{slug}:\\n"
+        "{incbin}  # {digest}\\n"
+        ".byte 0\\n"
+        EMBEDDED_SIZE("maf_embedded_{slug}")
+        ".popsection\\n");
+extern "C" const char maf_embedded_{slug}[];
 VFile {slug} = {{
   .path = "{escaped_path}"sv,
-  .content = ''',
-                  file=cc,
-                  end='')
-            buf = path.read_bytes()
-            bytes_per_line = 200
-            for i in range(0, len(buf), bytes_per_line):
-                chunk = buf[i:i + bytes_per_line]
-                print('\n    ' + cc_embed.bytes_to_c_string(chunk),
-                      file=cc,
-                      end='')
-            print(f'''sv,
+  .content = StrView(maf_embedded_{slug}, {path.stat().st_size}),
 }};''', file=cc)
         print('''std::unordered_map<StrView, VFile*> index = {''', file=cc)
         for path in embedded_paths:
@@ -78,6 +99,11 @@ VFile {slug} = {{
             print(f'  {{ {slug}.path, &{slug} }},', file=cc)
         print('};', file=cc)
         print('\n}  // namespace maf::embedded', file=cc)
+        fs_utils.write_if_changed(cc_path, cc.getvalue())
+
+
+# Files embedded by the current recipe
+embedded_files: list[Path] = []
 
 
 def hook_srcs(srcs: dict[str, src.File], recipe: make.Recipe):
@@ -87,6 +113,7 @@ def hook_srcs(srcs: dict[str, src.File], recipe: make.Recipe):
 
     # retain only files
     paths = [path for path in paths if path.is_file()]
+    embedded_files[:] = paths
 
     fs_utils.generated_dir.mkdir(exist_ok=True)
 
@@ -101,3 +128,10 @@ def hook_srcs(srcs: dict[str, src.File], recipe: make.Recipe):
     srcs[str(hh_path)] = hh_file
     cc_file = src.File(cc_path)
     srcs[str(cc_path)] = cc_file
+
+
+def hook_plan(srcs, objs, bins, recipe: make.Recipe):
+    # The files are read by `.incbin` - neither the scanner nor the depfiles know about them
+    for obj in objs:
+        if obj.source.path == cc_path:
+            obj.deps.update(embedded_files)
@@ -30,8 +30,11 @@
 #         name='Build GoogleTest')
 #     recipe.generated.add(GOOGLETEST_OUT)
 
-from subprocess import run
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run, CalledProcessError, PIPE, STDOUT
 import build
+import make
+import sys
 
 
 def hook_final(srcs, objs, bins, recipe):
@@ -39,10 +42,22 @@ def hook_final(srcs, objs, bins, recipe):
     tests = [
         bin for bin in bins if '-lgtest' in bin.link_args and bin.build_type == build.fast and bin.path.stem != 'gtest']
 
+    def run_test(test):
+        args = [str(test.path)] + test.run_args
+        if sys.stdout.isatty():  # output is captured so gtest can't detect the terminal by itself
+            args.append('--gtest_color=yes')
+        return run(args, stdout=PIPE, stderr=STDOUT)
+
     def run_tests():
-        for test in tests:
-            print(f'Running {test.path}')
-            run([str(test.path)] + test.run_args, check=True)
+        # Tests are independent so they run concurrently. Their output is printed (in order) once they finish.
+        with ThreadPoolExecutor(max_workers=make.available_cpus()) as executor:
+            results = executor.map(run_test, tests)
+            for test, result in zip(tests, results):
+                print(f'Running {test.path}', flush=True)
+                sys.stdout.buffer.write(result.stdout)
+                sys.stdout.flush()
+                if result.returncode:
+                    raise CalledProcessError(result.returncode, result.args)
 
     recipe.add_step(run_tests, outputs=[], inputs=tests,
                     desc='Running tests', shortcut='tests')
@@ -24,6 +24,10 @@ default_gn_args += ' skia_use_system_zlib=false'
 default_gn_args += ' skia_use_system_harfbuzz=false'
 default_gn_args += ' skia_use_system_freetype2=false'
 
+# Skia's own sources are compiled through the same compiler cache as Automat's
+if build.compiler_launcher:
+  default_gn_args += f' cc_wrapper="{" ".join(build.compiler_launcher)}"'
+
 @dataclass
 class BuildVariant:
   build_type: build.BuildType
@@ -126,9 +130,15 @@ skia_libs = set(['shshaper', 'skunicode', 'skia', 'skottie', 'svg'])
 # Binaries that should link to Skia
 skia_bins = set()
 
+skia_include_re = re.compile(r'(include|src)/.*Sk.*\.h')
+
 def hook_plan(srcs, objs, bins, recipe):
+  skia_bins.clear()  # extensions are kept loaded between the recipes
+  # Objects of all the build types share their sources - each source is checked once
+  skia_sources = set(file for file in set(obj.source for obj in objs)
+                     if any(skia_include_re.match(inc) for inc in file.system_includes))
   for obj in objs:
-    if any(re.match(r'(include|src)/.*Sk.*\.h', inc) for inc in obj.source.system_includes):
+    if obj.source in skia_sources:
       obj.deps.add(SKIA_ROOT)
 
   for bin in bins:
@@ -143,14 +153,11 @@ def hook_plan(srcs, objs, bins, recipe):
         
 
 def hook_final(srcs, objs, bins, recipe):
+  # Link steps are found through their outputs
+  build_types = {str(bin.path): bin.build_type for bin in skia_bins}
   for step in recipe.steps:
-    needs_skia = False
-    build_type = None
-    for bin in skia_bins:
-      if str(bin.path) in step.outputs:
-        needs_skia = True
-        build_type = bin.build_type
+    for output in step.outputs:
+      if build_type := build_types.get(output):
+        v = variants[build_type.name]
+        step.inputs.add(str(v.build_dir / libname))
         break
-    if needs_skia:
-      v = variants[build_type.name]
-      step.inputs.add(str(v.build_dir / libname))
@@ -48,6 +48,7 @@ def hook_recipe(recipe):
 vk_bootstrap_bins = set()
 
 def hook_plan(srcs, objs, bins, recipe):
+  vk_bootstrap_bins.clear()  # extensions are kept loaded between the recipes
   vk_bootstrap_objs = set()
   for obj in objs:
     if 'VkBootstrap.h' in obj.source.system_includes:
@@ -60,14 +61,10 @@ def hook_plan(srcs, objs, bins, recipe):
       vk_bootstrap_bins.add(bin)
 
 def hook_final(srcs, objs, bins, recipe):
+  # Link steps are found through their outputs
+  build_types = {str(bin.path): bin.build_type for bin in vk_bootstrap_bins}
   for step in recipe.steps:
-    needs_vk_bootstrap = False
-    build_type = None
-    for bin in vk_bootstrap_bins:
-      if str(bin.path) in step.outputs:
-        needs_vk_bootstrap = True
-        build_type = bin.build_type
+    for output in step.outputs:
+      if build_type := build_types.get(output):
+        step.inputs.add(str(get_build_dir(build_type) / libname))
         break
-    
-    if needs_vk_bootstrap:
-      step.inputs.add(str(get_build_dir(build_type) / libname))
@@ -12,6 +12,8 @@ xcb_libs = set(['xcb', 'xcb-xinput', 'xcb-xtest'])
 # Binaries that should link to XCB
 xcb_bins = set()
 
+xcb_include_re = re.compile(r'xcb/.*')
+
 def hook_srcs(srcs : dict[str, src.File], recipe):
   for src in srcs.values():
     if xcb_libs.intersection(src.comment_libs):
@@ -19,8 +21,12 @@ def hook_srcs(srcs : dict[str, src.File], recipe):
 
 
 def hook_plan(srcs, objs : list[build.ObjectFile], bins, recipe):
+  xcb_bins.clear()  # extensions are kept loaded between the recipes
+  # Objects of all the build types share their sources - each source is checked once
+  xcb_sources = set(file for file in set(obj.source for obj in objs)
+                    if any(xcb_include_re.match(inc) for inc in file.system_includes))
   for obj in objs:
-    if any(re.match(r'xcb/.*', inc) for inc in obj.source.system_includes):
+    if obj.source in xcb_sources:
       obj.deps.add(str(obj.build_type.PREFIX() / 'include' / 'xcb'))
 
   for bin in bins:
@@ -30,13 +36,10 @@ def hook_plan(srcs, objs : list[build.ObjectFile], bins, recipe):
 
 
 def hook_final(srcs, objs, bins, recipe):
+  # Link steps are found through their outputs
+  build_types = {str(bin.path): bin.build_type for bin in xcb_bins}
   for step in recipe.steps:
-    needs_xcb = False
-    build_type = None
-    for bin in xcb_bins:
-      if str(bin.path) in step.outputs:
-        needs_xcb = True
-        build_type = bin.build_type
+    for output in step.outputs:
+      if build_type := build_types.get(output):
+        step.inputs.add(str(build_type.PREFIX() / 'lib' / 'libxcb.a'))
         break
-    if needs_xcb:
-      step.inputs.add(str(build_type.PREFIX() / 'lib' / 'libxcb.a'))